@@ -20,6 +20,13 @@ from data import create_dataset
 from models.arch_util import PixelUnshuffle
 from utils.util import opt_get
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it, the functions it would compile just run in the interpreter.
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
 
 class RandomApply(nn.Module):
     def __init__(self, fn, p):
@@ -27,36 +34,75 @@ class RandomApply(nn.Module):
         self.fn = fn
         self.p = p
     def forward(self, x):
-        if random.random() > self.p:
-            return x
-        return self.fn(x)
+        if len(x.shape) != 4:
+            if random.random() > self.p:
+                return x
+            return self.fn(x)
+        # Batched inputs get an independent decision per image.
+        apply = torch.rand(x.shape[0], device=x.device) < self.p
+        return torch.where(apply.view(-1, 1, 1, 1), self.fn(x), x)
+
+
+# Gaussian blur with a fixed kernel size and sigma. kornia's GaussianBlur2d rebuilds its kernel on every call; this
+# builds it once and applies it as a depthwise convolution. Expects (B,C,H,W) inputs.
+class FixedGaussianBlur(nn.Module):
+    def __init__(self, kernel_size, sigma):
+        super().__init__()
+        kernel = filters.get_gaussian_kernel2d((kernel_size, kernel_size), (sigma, sigma))
+        self.register_buffer('kernel', kernel.reshape(1, 1, kernel_size, kernel_size), persistent=False)
+        self.pad = kernel_size // 2
+
+    def forward(self, x):
+        kernel = self.kernel.to(x)
+        c = x.shape[1]
+        x = F.pad(x, (self.pad,) * 4, mode='reflect')
+        return F.conv2d(x, kernel.expand(c, -1, -1, -1), groups=c)
+
+
+# Builds the augmentation stack from the BYOL paper. Meant to be run against batches of images on the GPU by
+# ByolAugmentInjector; kornia processes a whole batch in the same number of kernel launches it takes for one image.
+def byol_augmentations(crop_size, for_sr=False):
+    augmentations = [ \
+        augs.RandomHorizontalFlip(),
+        augs.RandomResizedCrop((crop_size, crop_size))]
+    if not for_sr:
+        augmentations.extend([RandomApply(augs.ColorJitter(0.8, 0.8, 0.8, 0.2), p=0.8),
+                              augs.RandomGrayscale(p=0.2),
+                              RandomApply(FixedGaussianBlur(3, 1.5), p=0.1)])
+    return nn.Sequential(*augmentations)
+
 
+# Quantizes an image in [0,1] to uint8. Images cross the DataLoader and the host->device copy at a quarter of the
+# bandwidth they would as float32; use uint8_to_float() once they are on the GPU to recover them.
+def float_to_uint8(im):
+    return (im * 255).round_().clamp_(0, 255).to(torch.uint8)
 
+
+def uint8_to_float(im):
+    if im.dtype != torch.uint8:
+        return im
+    return im.float().div_(255)
+
+
+# Dataset half of BYOL: passes the two images that will be augmented through the DataLoader untouched. The actual
+# augmentations are performed on the GPU by ByolAugmentInjector, which should be configured to consume [key1, key2]
+# and produce [aug1, aug2].
 class ByolDatasetWrapper(Dataset):
     def __init__(self, opt):
         super().__init__()
         self.wrapped_dataset = create_dataset(opt['dataset'])
-        self.cropped_img_size = opt['crop_size']
         self.key1 = opt_get(opt, ['key1'], 'hq')
         self.key2 = opt_get(opt, ['key2'], 'lq')
-        for_sr = opt_get(opt, ['for_sr'], False)  # When set, color alterations and blurs are disabled.
-
-        augmentations = [ \
-            augs.RandomHorizontalFlip(),
-            augs.RandomResizedCrop((self.cropped_img_size, self.cropped_img_size))]
-        if not for_sr:
-            augmentations.extend([RandomApply(augs.ColorJitter(0.8, 0.8, 0.8, 0.2), p=0.8),
-                                  augs.RandomGrayscale(p=0.2),
-                                  RandomApply(filters.GaussianBlur2d((3, 3), (1.5, 1.5)), p=0.1)])
-        if opt['normalize']:
-            # The paper calls for normalization. Most datasets/models in this repo don't use this.
-            # Recommend setting true if you want to train exactly like the paper.
-            augmentations.append(augs.Normalize(mean=torch.tensor([0.485, 0.456, 0.406]), std=torch.tensor([0.229, 0.224, 0.225])))
-        self.aug = nn.Sequential(*augmentations)
+        # When set, images are sent to the GPU as uint8. Only valid for wrapped datasets that produce images in [0,1].
+        self.uint8_transfer = opt_get(opt, ['uint8_transfer'], False)
 
     def __getitem__(self, item):
         item = self.wrapped_dataset[item]
-        item.update({'aug1': self.aug(item[self.key1]).squeeze(dim=0), 'aug2': self.aug(item[self.key2]).squeeze(dim=0)})
+        assert self.key1 in item.keys() and self.key2 in item.keys()
+        if self.uint8_transfer:
+            for k in {self.key1, self.key2}:
+                assert item[k].min() >= 0 and item[k].max() <= 1, 'uint8_transfer requires images in [0,1].'
+                item[k] = float_to_uint8(item[k])
         return item
 
     def __len__(self):
@@ -74,7 +120,7 @@ class DatasetRandomAugWrapper(Dataset):
         augmentations = [ \
             RandomApply(augs.ColorJitter(0.4, 0.4, 0.4, 0.2), p=0.8),
             augs.RandomGrayscale(p=0.2),
-            RandomApply(filters.GaussianBlur2d((3, 3), (1.5, 1.5)), p=0.1)]
+            RandomApply(FixedGaussianBlur(3, 1.5), p=0.1)]
         self.aug = nn.Sequential(*augmentations)
         self.rrc = nn.Sequential(*[
             augs.RandomHorizontalFlip(),
@@ -147,30 +193,47 @@ def test_dataset_random_aug_wrapper():
                     torchvision.utils.save_image(moremask.unsqueeze(0), "debug/%i_%s_%s.png" % (i, k, o['label_strings'][randlbl]))
 
 
-def no_batch_interpolate(i, size, mode):
-    i = i.unsqueeze(0)
-    i = F.interpolate(i, size=size, mode=mode)
-    return i.squeeze(0)
-
-
-# Performs a 1-d translation of "other":
-# If other<ref, returns 0.
-# Else: return other-ref
-def snap(ref, other):
-    if other < ref:
-        return 0
-    return other - ref
-
-
 # Pads a tensor with zeros so that it fits in a dxd square.
 def pad_to(im, d):
-    if len(im.shape) == 3:
-        pd = torch.zeros((im.shape[0],d,d))
-        pd[:, :im.shape[1], :im.shape[2]] = im
-    else:
-        pd = torch.zeros((im.shape[0],im.shape[1],d,d), device=im.device)
-        pd[:, :, :im.shape[2], :im.shape[3]] = im
-    return pd
+    return F.pad(im, (0, d - im.shape[-1], 0, d - im.shape[-2]))
+
+
+# Builds a (1,h,w) mask which is 1 inside the rh x rw rectangle whose top-left corner is at (t,l), and [fill] elsewhere.
+def rect_mask(h, w, t, l, rh, rw, fill):
+    # The shared region is empty (and can have a negative size) when the patches do not overlap.
+    rh, rw = max(rh, 0), max(rw, 0)
+    t, l = min(max(t, 0), h - rh), min(max(l, 0), w - rw)
+    return F.pad(torch.ones((1, rh, rw)), (l, w - l - rw, t, h - t - rh), value=fill)
+
+
+# Computes the patch coordinates, jitter and shared region for RandomSharedRegionCrop. All coordinates are in units of
+# [m], jitter is in pixels. Random samples are drawn by the caller with torch so that the per-worker seeding done by the
+# DataLoader applies; numba keeps its own RNG state. [u] holds uniform samples in [0,1), [j] holds raw jitter samples.
+@njit(cache=True, nogil=True)
+def shared_region_coordinates(d, m, u, j):
+    # Each coordinate is drawn uniformly from a range which depends on the coordinates drawn before it.
+    base_w = d//2+1 + int(u[0] * (d-1-d//2))  # [d//2+1, d-1]
+    base_l = int(u[1] * (d-base_w+1))  # [0, d-base_w]
+    base_h = base_w-1 + int(u[2] * 3)  # [base_w-1, base_w+1]
+    base_t = int(u[3] * (d-base_h+1))  # [0, d-base_h]
+    im2_w = d//2+1 + int(u[4] * (d-1-d//2))
+    im2_l = int(u[5] * (d-im2_w+1))
+    im2_h = im2_w-1 + int(u[6] * 3)
+    im2_t = int(u[7] * (d-im2_h+1))
+
+    # Jitter is clamped so that it can never push a patch outside of the image bounds.
+    jt1 = min(max(j[0], -base_t*m), (d-base_t-base_h)*m)
+    jl1 = min(max(j[1], -base_l*m), (d-base_l-base_w)*m)
+    jt2 = min(max(j[2], -im2_t*m), (d-im2_t-im2_h)*m)
+    jl2 = min(max(j[3], -im2_l*m), (d-im2_l-im2_w)*m)
+
+    # The offset of the shared region within each patch is how far the other patch starts past this one.
+    i1_shared_t, i1_shared_l = max(im2_t-base_t, 0), max(im2_l-base_l, 0)
+    i2_shared_t, i2_shared_l = max(base_t-im2_t, 0), max(base_l-im2_l, 0)
+    ix_h = min(base_t+base_h, im2_t+im2_h) - max(base_t, im2_t)
+    ix_w = min(base_l+base_w, im2_l+im2_w) - max(base_l, im2_l)
+    return base_t, base_l, base_h, base_w, jt1, jl1, im2_t, im2_l, im2_h, im2_w, jt2, jl2, \
+        i1_shared_t, i1_shared_l, i2_shared_t, i2_shared_l, ix_h, ix_w
 
 
 # Variation of RandomResizedCrop, which picks a region of the image that the two augments must share. The augments
@@ -184,7 +247,8 @@ class RandomSharedRegionCrop(nn.Module):
         self.multiple = multiple
         self.jitter_range = jitter_range  # When specified, images are shifted an additional random([-j,j]) pixels where j=jitter_range
 
-    def forward(self, i1, i2):
+    # Steps 7 and 8 only produce visualizations and are skipped (returning None in their place) unless return_debug is set.
+    def forward(self, i1, i2, return_debug=False):
         assert i1.shape[-1] == i2.shape[-1]
         # Outline of the general algorithm:
         # 1. Assume the input is a square. Divide it by self.multiple to get working units.
@@ -202,58 +266,33 @@ class RandomSharedRegionCrop(nn.Module):
         assert d % self.multiple == 0 and d > (self.multiple*3)
         d = d // self.multiple
 
-        # Step 2
-        base_w = random.randint(d//2+1, d-1)
-        base_l = random.randint(0, d-base_w)
-        base_h = random.randint(base_w-1, base_w+1)
-        base_t = random.randint(0, d-base_h)
-        base_r, base_b = base_l+base_w, base_t+base_h
-
-        # Step 3
-        im2_w = random.randint(d//2+1, d-1)
-        im2_l = random.randint(0, d-im2_w)
-        im2_h = random.randint(im2_w-1, im2_w+1)
-        im2_t = random.randint(0, d-im2_h)
-        im2_r, im2_b = im2_l+im2_w, im2_t+im2_h
+        # Steps 2, 3, 4 (coordinates) & 6
+        m = self.multiple
+        u = torch.rand(9).numpy()
+        j = torch.randint(-self.jitter_range, self.jitter_range+1, (4,)).numpy()
+        base_t, base_l, base_h, base_w, jt1, jl1, im2_t, im2_l, im2_h, im2_w, jt2, jl2, \
+            i1_shared_t, i1_shared_l, i2_shared_t, i2_shared_l, ix_h, ix_w = shared_region_coordinates(d, m, u, j)
 
         # Step 4
-        m = self.multiple
-        jl, jt = random.randint(-self.jitter_range, self.jitter_range), random.randint(-self.jitter_range, self.jitter_range)
-        jt = jt if base_t != 0 else abs(jt)  # If the top of a patch is zero, a negative jitter will cause it to go negative.
-        jt = jt if (base_t+base_h)*m != i1.shape[1] else 0 # Likewise, jitter shouldn't allow the patch to go over-bounds.
-        jl = jl if base_l != 0 else abs(jl)
-        jl = jl if (base_l+base_w)*m != i1.shape[1] else 0
-        p1 = i1[:, base_t*m+jt:(base_t+base_h)*m+jt, base_l*m+jl:(base_l+base_w)*m+jl]
-        p1_resized = no_batch_interpolate(p1, size=(d*m, d*m), mode="bilinear")
-        jl, jt = random.randint(-self.jitter_range, self.jitter_range), random.randint(-self.jitter_range, self.jitter_range)
-        jt = jt if im2_t != 0 else abs(jt)
-        jt = jt if (im2_t+im2_h)*m != i2.shape[1] else 0
-        jl = jl if im2_l != 0 else abs(jl)
-        jl = jl if (im2_l+im2_w)*m != i2.shape[1] else 0
-        p2 = i2[:, im2_t*m+jt:(im2_t+im2_h)*m+jt, im2_l*m+jl:(im2_l+im2_w)*m+jl]
-        p2_resized = no_batch_interpolate(p2, size=(d*m, d*m), mode="bilinear")
+        p1 = i1[:, base_t*m+jt1:(base_t+base_h)*m+jt1, base_l*m+jl1:(base_l+base_w)*m+jl1]
+        p1_resized = F.interpolate(p1[None], size=(d*m, d*m), mode="bilinear", align_corners=False)[0]
+        p2 = i2[:, im2_t*m+jt2:(im2_t+im2_h)*m+jt2, im2_l*m+jl2:(im2_l+im2_w)*m+jl2]
+        p2_resized = F.interpolate(p2[None], size=(d*m, d*m), mode="bilinear", align_corners=False)[0]
 
         # Step 5
-        should_flip = random.random() < .5
+        should_flip = int(u[8] < .5)
         if should_flip:
-            should_flip = 1
             p2_resized = geometry.transform.hflip(p2_resized)
-        else:
-            should_flip = 0
-
-        # Step 6
-        i1_shared_t, i1_shared_l = snap(base_t, im2_t), snap(base_l, im2_l)
-        i2_shared_t, i2_shared_l = snap(im2_t, base_t), snap(im2_l, base_l)
-        ix_h = min(base_b, im2_b) - max(base_t, im2_t)
-        ix_w = min(base_r, im2_r) - max(base_l, im2_l)
+
         recompute_package = torch.tensor([d, base_h, base_w, i1_shared_t, i1_shared_l, im2_h, im2_w, i2_shared_t, i2_shared_l, should_flip, ix_h, ix_w], dtype=torch.long)
 
+        if not return_debug:
+            return p1_resized, p2_resized, recompute_package, None, None, None, None, None
+
         # Step 7
-        mask1 = torch.full((1, base_h*m, base_w*m), fill_value=.5)
-        mask1[:, i1_shared_t*m:(i1_shared_t+ix_h)*m, i1_shared_l*m:(i1_shared_l+ix_w)*m] = 1
+        mask1 = rect_mask(base_h*m, base_w*m, i1_shared_t*m, i1_shared_l*m, ix_h*m, ix_w*m, fill=.5)
         masked1 = pad_to(p1 * mask1, d*m)
-        mask2 = torch.full((1, im2_h*m, im2_w*m), fill_value=.5)
-        mask2[:, i2_shared_t*m:(i2_shared_t+ix_h)*m, i2_shared_l*m:(i2_shared_l+ix_w)*m] = 1
+        mask2 = rect_mask(im2_h*m, im2_w*m, i2_shared_t*m, i2_shared_l*m, ix_h*m, ix_w*m, fill=.5)
         masked2 = pad_to(p2 * mask2, d*m)
         mask = torch.full((1, d*m, d*m), fill_value=.33)
         mask[:, base_t*m:(base_t+base_w)*m, base_l*m:(base_l+base_h)*m] += .33
@@ -270,31 +309,45 @@ class RandomSharedRegionCrop(nn.Module):
         return p1_resized, p2_resized, recompute_package, masked1, masked2, masked_dbg, i1_shared, i2_shared
 
 
+# Fields of the recompute package built by RandomSharedRegionCrop. A batch of packages is a [B,12] tensor, so every
+# field can be read for the whole batch at once as a column.
+PKG_DIM, PKG_F1_H, PKG_F1_W, PKG_F1_T, PKG_F1_L, PKG_F2_H, PKG_F2_W, PKG_F2_T, PKG_F2_L, PKG_FLIP, PKG_S_H, PKG_S_W = range(12)
+
+
 # Uses the recompute package returned from the above dataset to extract matched-size "similar regions" from two feature
 # maps.
 def reconstructed_shared_regions(fea1, fea2, recompute_package: torch.Tensor):
     package = recompute_package.cpu()
-    res1 = []
-    res2 = []
-    pad_dim = torch.max(package[:, -2:]).item()
-    # It'd be real nice if we could do this at the batch level, but I don't see a really good way to do that outside
-    # of conforming the recompute_package across the entire batch.
-    for b in range(package.shape[0]):
-        expected_dim, f1_h, f1_w, f1s_t, f1s_l, f2_h, f2_w, f2s_t, f2s_l, should_flip, s_h, s_w = tuple(package[b].tolist())
-        # If you are hitting this assert, you specified `latent_multiple` in your dataset config wrong.
-        assert expected_dim == fea1.shape[2] and expected_dim == fea2.shape[2]
-
-        # Unflip 2 if needed.
-        f2 = fea2[b]
-        if should_flip == 1:
-            f2 = kornia.geometry.transform.hflip(f2)
-        # Resize the input features to match
-        f1s = F.interpolate(fea1[b].unsqueeze(0), (f1_h, f1_w), mode="nearest")
-        f2s = F.interpolate(f2.unsqueeze(0), (f2_h, f2_w), mode="nearest")
-        # Outputs must be padded so they can "get along" with each other.
-        res1.append(pad_to(f1s[:, :, f1s_t:f1s_t+s_h, f1s_l:f1s_l+s_w], pad_dim))
-        res2.append(pad_to(f2s[:, :, f2s_t:f2s_t+s_h, f2s_l:f2s_l+s_w], pad_dim))
-    return torch.cat(res1, dim=0), torch.cat(res2, dim=0)
+    # If you are hitting this assert, you specified `latent_multiple` in your dataset config wrong.
+    assert (package[:, PKG_DIM] == fea1.shape[2]).all() and (package[:, PKG_DIM] == fea2.shape[2]).all()
+
+    # Unflip 2 where needed.
+    should_flip = package[:, PKG_FLIP] == 1
+    if should_flip.any():
+        should_flip = should_flip.to(fea2.device).view(-1, 1, 1, 1)
+        fea2 = torch.where(should_flip, kornia.geometry.transform.hflip(fea2), fea2)
+
+    fields = package.t().tolist()
+    # With an odd `dim`, the patches may not overlap at all, which shows up as a negative shared region size.
+    s_h, s_w = [max(v, 0) for v in fields[PKG_S_H]], [max(v, 0) for v in fields[PKG_S_W]]
+    pad_dim = max(s_h + s_w)
+    res1 = fea1.new_zeros((fea1.shape[0], fea1.shape[1], pad_dim, pad_dim))
+    res2 = fea2.new_zeros((fea2.shape[0], fea2.shape[1], pad_dim, pad_dim))
+    for fea, res, (h_field, w_field, t_field, l_field) in ((fea1, res1, (PKG_F1_H, PKG_F1_W, PKG_F1_T, PKG_F1_L)),
+                                                           (fea2, res2, (PKG_F2_H, PKG_F2_W, PKG_F2_T, PKG_F2_L))):
+        # Resize the input features to match. The target size varies per sample, but samples that share a target
+        # size are resized together.
+        sizes, bucket = torch.unique(package[:, [h_field, w_field]], dim=0, return_inverse=True)
+        t, l = fields[t_field], fields[l_field]
+        for k, size in enumerate(sizes.tolist()):
+            idx = (bucket == k).nonzero().squeeze(1)
+            resized = F.interpolate(fea[idx.to(fea.device)], size, mode="nearest")
+            # Outputs are written into a zero-padded buffer so they can "get along" with each other.
+            for r, b in zip(resized, idx.tolist()):
+                if s_h[b] == 0 or s_w[b] == 0:
+                    continue
+                res[b, :, :s_h[b], :s_w[b]] = r[:, t[b]:t[b]+s_h[b], l[b]:l[b]+s_w[b]]
+    return res1, res2
 
 
 # Follows the general template of BYOL dataset, with the following changes:
@@ -302,25 +355,44 @@ def reconstructed_shared_regions(fea1, fea2, recompute_package: torch.Tensor):
 # 2. Instead of RandomResizedCrop, a custom Transform, RandomSharedRegionCrop is used.
 # 3. The dataset injects two integer tensors alongside the augmentations, which are used to index image regions shared
 #    by the joint augmentations.
-# 4. The dataset injects an aug_shared_view for debugging purposes.
+# 4. When `debug` is set, the dataset injects masked views of each augmentation, an aug_shared_view and the shared
+#    regions themselves for debugging purposes.
 class StructuredCropDatasetWrapper(Dataset):
     def __init__(self, opt):
         super().__init__()
         self.wrapped_dataset = create_dataset(opt['dataset'])
-        augmentations = [RandomApply(augs.ColorJitter(0.8, 0.8, 0.8, 0.2), p=0.8),
-            augs.RandomGrayscale(p=0.2),
-            RandomApply(filters.GaussianBlur2d((3, 3), (1.5, 1.5)), p=0.1)]
-        self.aug = nn.Sequential(*augmentations)
+        # These run on one unbatched image at a time in the dataloader workers, where torchvision outperforms kornia.
+        # transforms.v2 needs torchvision>=0.15. The v1 transforms take the same arguments and also handle uint8 tensors.
+        try:
+            from torchvision.transforms import v2 as T
+        except ImportError:
+            import torchvision.transforms as T
+        self.aug = T.Compose([T.RandomApply([T.ColorJitter(0.8, 0.8, 0.8, 0.2)], p=0.8),
+                              T.RandomGrayscale(p=0.2),
+                              T.RandomApply([T.GaussianBlur(3, sigma=(1.5, 1.5))], p=0.1)])
         self.rrc = RandomSharedRegionCrop(opt['latent_multiple'], opt_get(opt, ['jitter_range'], 0))
+        # When set, images are augmented as uint8 (for which torchvision has native kernels) and hq, lq, aug1 and aug2
+        # are sent to the GPU as uint8. Convert them back with the uint8_to_float injector.
+        self.uint8_transfer = opt_get(opt, ['uint8_transfer'], False)
+        self.debug = opt_get(opt, ['debug'], False)
 
     def __getitem__(self, item):
         item = self.wrapped_dataset[item]
-        a1 = self.aug(item['hq']).squeeze(dim=0)
-        a2 = self.aug(item['lq']).squeeze(dim=0)
-        a1, a2, sr_dim, m1, m2, db, i1s, i2s = self.rrc(a1, a2)
-        item.update({'aug1': a1, 'aug2': a2, 'similar_region_dimensions': sr_dim,
-                     'masked1': m1, 'masked2': m2, 'aug_shared_view': db,
-                     'i1_shared': i1s, 'i2_shared': i2s})
+        hq, lq = item['hq'], item['lq']
+        if self.uint8_transfer:
+            assert min(hq.min(), lq.min()) >= 0 and max(hq.max(), lq.max()) <= 1, 'uint8_transfer requires images in [0,1].'
+            hq, lq = float_to_uint8(hq), float_to_uint8(lq)
+            item['hq'], item['lq'] = hq, lq
+        # RandomSharedRegionCrop interpolates, so it needs floats.
+        a1 = uint8_to_float(self.aug(hq))
+        a2 = uint8_to_float(self.aug(lq))
+        a1, a2, sr_dim, m1, m2, db, i1s, i2s = self.rrc(a1, a2, return_debug=self.debug)
+        if self.uint8_transfer:
+            a1, a2 = float_to_uint8(a1), float_to_uint8(a2)
+        item.update({'aug1': a1, 'aug2': a2, 'similar_region_dimensions': sr_dim})
+        if self.debug:
+            item.update({'masked1': m1, 'masked2': m2, 'aug_shared_view': db,
+                         'i1_shared': i1s, 'i2_shared': i2s})
         return item
 
     def __len__(self):
@@ -346,6 +418,7 @@ def test_structured_crop_dataset_wrapper():
             },
         'latent_multiple': 16,
         'jitter_range': 0,
+        'debug': True,
     }
 
     ds = StructuredCropDatasetWrapper(opt)
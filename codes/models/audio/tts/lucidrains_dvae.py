@@ -5,7 +5,6 @@ from math import sqrt
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 from torch import einsum
 from vector_quantize_pytorch import VectorQuantize
 
@@ -18,6 +17,10 @@ def default(val, d):
     return val if val is not None else d
 
 
+# Excludes a function from torch.compile graphs. A no-op on versions of torch without torch.compiler.
+compiler_disable = getattr(getattr(torch, 'compiler', None), 'disable', lambda fn: fn)
+
+
 def eval_decorator(fn):
     def inner(model, *args, **kwargs):
         was_training = model.training
@@ -144,6 +147,10 @@ class DiscreteVAE(nn.Module):
 
         self.encoder = nn.Sequential(*enc_layers)
         self.decoder = nn.Sequential(*dec_layers)
+        if positional_dims == 2:
+            # NHWC lets cuDNN use its tensor core kernels and turns the permute in front of the codebook into a view.
+            self.encoder = self.encoder.to(memory_format=torch.channels_last)
+            self.decoder = self.decoder.to(memory_format=torch.channels_last)
 
         self.loss_fn = F.smooth_l1_loss if smooth_l1_loss else F.mse_loss
 
@@ -154,28 +161,29 @@ class DiscreteVAE(nn.Module):
 
         # take care of normalization within class
         self.normalization = normalization
+        if normalization is not None:
+            means, stds = map(lambda t: torch.as_tensor(t, dtype=torch.float), normalization)
+            shape = (1, -1, 1, 1) if positional_dims == 2 else (1, -1, 1)
+            self.register_buffer('_norm_mean', means.view(shape), persistent=False)
+            self.register_buffer('_norm_std_inv', 1 / stds.view(shape), persistent=False)
         self.record_codes = record_codes
         if record_codes:
+            # Not a buffer, so DDP does not broadcast it. Moved to the device of the codes on first write so recording
+            # them does not force a device sync.
             self.codes = torch.zeros((1228800,), dtype=torch.long)
             self.code_ind = 0
             self.total_codes = 0
         self.internal_step = 0
 
     def norm(self, images):
-        if not self.normalization is not None:
+        if self.normalization is None:
             return images
-
-        means, stds = map(lambda t: torch.as_tensor(t).to(images), self.normalization)
-        arrange = 'c -> () c () ()' if self.positional_dims == 2 else 'c -> () c ()'
-        means, stds = map(lambda t: rearrange(t, arrange), (means, stds))
-        images = images.clone()
-        images.sub_(means).div_(stds)
-        return images
+        return (images - self._norm_mean) * self._norm_std_inv
 
     def get_debug_values(self, step, __):
         if self.record_codes and self.total_codes > 0:
             # Report annealing schedule
-            return {'histogram_codes': self.codes[:self.total_codes]}
+            return {'histogram_codes': self.codes[:self.total_codes].cpu()}
         else:
             return {}
 
@@ -199,14 +207,11 @@ class DiscreteVAE(nn.Module):
             image_embeds = F.embedding(img_seq, self.codebook.codebook)
         b, n, d = image_embeds.shape
 
-        kwargs = {}
         if self.positional_dims == 1:
-            arrange = 'b n d -> b d n'
+            image_embeds = image_embeds.transpose(1, 2)
         else:
             h = w = int(sqrt(n))
-            arrange = 'b (h w) d -> b d h w'
-            kwargs = {'h': h, 'w': w}
-        image_embeds = rearrange(image_embeds, arrange, **kwargs)
+            image_embeds = image_embeds.view(b, h, w, d).permute(0, 3, 1, 2)
         images = [image_embeds]
         for layer in self.decoder:
             images.append(layer(images[-1]))
@@ -226,6 +231,8 @@ class DiscreteVAE(nn.Module):
         img
     ):
         img = self.norm(img)
+        if len(img.shape) == 4:
+            img = img.contiguous(memory_format=torch.channels_last)
         logits = self.encoder(img).permute((0,2,3,1) if len(img.shape) == 4 else (0,2,1))
         sampled, codes, commitment_loss = self.codebook(logits)
         sampled = sampled.permute((0,3,1,2) if len(img.shape) == 4 else (0,2,1))
@@ -244,13 +251,17 @@ class DiscreteVAE(nn.Module):
 
         return recon_loss, commitment_loss, out
 
+    # Code logging mutates Python-side counters on every call, which would force a compiled forward() to recompile.
+    @compiler_disable
     def log_codes(self, codes):
         # This is so we can debug the distribution of codes being learned.
         if self.record_codes and self.internal_step % 10 == 0:
             codes = codes.flatten()
             l = codes.shape[0]
             i = self.code_ind if (self.codes.shape[0] - self.code_ind) > l else self.codes.shape[0] - l
-            self.codes[i:i+l] = codes.cpu()
+            if self.codes.device != codes.device:
+                self.codes = self.codes.to(codes.device)
+            self.codes[i:i+l] = codes.detach()
             self.code_ind = self.code_ind + l
             if self.code_ind >= self.codes.shape[0]:
                 self.code_ind = 0
@@ -260,7 +271,12 @@ class DiscreteVAE(nn.Module):
 
 @register_model
 def register_lucidrains_dvae(opt_net, opt):
-    return DiscreteVAE(**opt_get(opt_net, ['kwargs'], {}))
+    v = DiscreteVAE(**opt_get(opt_net, ['kwargs'], {}))
+    if opt_get(opt_net, ['compile'], False):
+        # Specializes the model to the fixed input shape used in training. Compiling in-place leaves parameter names
+        # (and thus checkpoints) untouched.
+        v.compile(mode='max-autotune', dynamic=False)
+    return v
 
 
 if __name__ == '__main__':
@@ -20,8 +20,8 @@ from .numbers import normalize_numbers
 # Regular expression matching whitespace:
 _whitespace_re = re.compile(r'\s+')
 
-# List of (regular expression, replacement) pairs for abbreviations:
-_abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in [
+# List of (abbreviation, replacement) pairs:
+_abbreviations = [
   ('mrs', 'misess'),
   ('mr', 'mister'),
   ('dr', 'doctor'),
@@ -40,13 +40,30 @@ _abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in
   ('ltd', 'limited'),
   ('col', 'colonel'),
   ('ft', 'fort'),
-]]
+]
+
+# All abbreviations are matched by a single alternation so the text only needs to be scanned once. Unlike the old
+# per-abbreviation re.sub loop, this intentionally expands back-to-back abbreviations too, since word boundaries are
+# checked against the original text: "Dr.St. John" -> "doctorsaint John" (previously "doctorst. John").
+_abbreviations_re = re.compile(r'\b(%s)\.' % '|'.join(re.escape(x[0]) for x in _abbreviations), re.IGNORECASE)
+_abbreviations_map = {x[0]: x[1] for x in _abbreviations}
+
+# Abbreviation expansion, whitespace collapsing and quote removal fused into a single pass for english_cleaners. This
+# shares _abbreviations_re's intentional change for back-to-back abbreviations, so english_cleaners output differs from
+# older checkouts for such inputs, e.g. "mrs.dr." -> "misessdoctor" (previously "misessdr."):
+_english_final_re = re.compile(r'\b(%s)\.|(\s+)|"' % '|'.join(re.escape(x[0]) for x in _abbreviations), re.IGNORECASE)
+
+
+def _english_final_sub(m):
+  if m.group(1) is not None:
+    return _abbreviations_map[m.group(1).lower()]
+  if m.group(2) is not None:
+    return ' '
+  return ''
 
 
 def expand_abbreviations(text):
-  for regex, replacement in _abbreviations:
-    text = re.sub(regex, replacement, text)
-  return text
+  return _abbreviations_re.sub(lambda m: _abbreviations_map[m.group(1).lower()], text)
 
 
 def expand_numbers(text):
@@ -80,8 +97,8 @@ def transliteration_cleaners(text):
   return text
 
 
-# List of (regular expression, replacement) pairs for abbreviations:
-_ckb_transliterate = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in [
+# Translation table mapping Kurdish (Sorani) characters to their latin transliterations:
+_ckb_transliterate = str.maketrans({x[0]: x[1] for x in [
 ('ؤ','o'),
 ('ئ','eh'),
 ('ا','aa'),
@@ -121,13 +138,14 @@ _ckb_transliterate = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x
 ('ی','y'),
 ('ێ','y'),
 ('ە','eh')
-]]
+]})
 
 
 def ckb_transliterate(text):
-  for regex, replacement in _ckb_transliterate:
-    text = re.sub(regex, replacement, text)
-  return text
+  # Most inputs are plain English; str.isascii() is O(1) and lets them skip the per-character table lookup entirely.
+  if text.isascii():
+    return text
+  return text.translate(_ckb_transliterate)
 
 
 def english_cleaners(text):
@@ -136,7 +154,5 @@ def english_cleaners(text):
   text = convert_to_ascii(text)
   text = lowercase(text)
   text = expand_numbers(text)
-  text = expand_abbreviations(text)
-  text = collapse_whitespace(text)
-  text = text.replace('"', '')
+  text = _english_final_re.sub(_english_final_sub, text)
   return text
@@ -6,10 +6,9 @@ import kornia.augmentation as augs
 import torch
 import torch.nn.functional as F
 import torchvision
-from kornia import filters
 from torch import nn
 
-from data.images.byol_attachment import RandomApply
+from data.images.byol_attachment import RandomApply, FixedGaussianBlur
 from trainer.networks import register_model, create_model
 from utils.util import checkpoint, opt_get
 import maybe_bnb as mbnb
@@ -203,7 +202,7 @@ class BYOL(nn.Module):
                 RandomApply(augs.ColorJitter(0.8, 0.8, 0.8, 0.2), p=0.8),
                 augs.RandomGrayscale(p=0.2),
                 augs.RandomHorizontalFlip(),
-                RandomApply(filters.GaussianBlur2d((3, 3), (1.5, 1.5)), p=0.1),
+                RandomApply(FixedGaussianBlur(3, 1.5), p=0.1),
                 augs.RandomResizedCrop((image_size, image_size))]
             self.aug = nn.Sequential(*augmentations)
         self.use_momentum = use_momentum
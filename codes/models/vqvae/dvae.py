@@ -5,7 +5,6 @@ from math import sqrt
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 from torch import einsum
 
 from models.vqvae.vector_quantizer import VectorQuantize
@@ -135,6 +134,8 @@ class DiscreteVAE(nn.Module):
 
         self.record_codes = record_codes
         if record_codes:
+            # Not a buffer, so DDP does not broadcast it. Moved to the device of the codes on first write so recording
+            # them does not force a device sync.
             self.codes = torch.zeros((1228800,), dtype=torch.long)
             self.code_ind = 0
         self.internal_step = 0
@@ -142,7 +143,7 @@ class DiscreteVAE(nn.Module):
     def get_debug_values(self, step, __):
         if self.record_codes:
             # Report annealing schedule
-            return {'histogram_codes': self.codes}
+            return {'histogram_codes': self.codes.cpu()}
         else:
             return {}
 
@@ -161,14 +162,11 @@ class DiscreteVAE(nn.Module):
         image_embeds = self.quantizer.decode(img_seq)
         b, n, d = image_embeds.shape
 
-        kwargs = {}
         if self.positional_dims == 1:
-            arrange = 'b n d -> b d n'
+            image_embeds = image_embeds.transpose(1, 2)
         else:
             h = w = int(sqrt(n))
-            arrange = 'b (h w) d -> b d h w'
-            kwargs = {'h': h, 'w': w}
-        image_embeds = rearrange(image_embeds, arrange, **kwargs)
+            image_embeds = image_embeds.view(b, h, w, d).permute(0, 3, 1, 2)
         images = [image_embeds]
         for layer in self.decoder:
             images.append(layer(images[-1]))
@@ -212,7 +210,9 @@ class DiscreteVAE(nn.Module):
             codes = codes.flatten()
             l = codes.shape[0]
             i = self.code_ind if (self.codes.shape[0] - self.code_ind) > l else self.codes.shape[0] - l
-            self.codes[i:i+l] = codes.cpu()
+            if self.codes.device != codes.device:
+                self.codes = self.codes.to(codes.device)
+            self.codes[i:i+l] = codes.detach()
             self.code_ind = self.code_ind + l
             if self.code_ind >= self.codes.shape[0]:
                 self.code_ind = 0
@@ -379,6 +379,8 @@ class ExtensibleTrainer(BaseModel):
         # Record visual outputs for usage in debugging and testing.
         if 'visuals' in self.opt['logger'].keys() and self.rank <= 0 and it % self.opt['logger']['visual_debug_rate'] == 0:
             def fix_image(img):
+                if img.dtype == torch.uint8:
+                    img = img.float() / 255  # Datasets with `uint8_transfer` set produce uint8 images in [0,255].
                 if opt_get(self.opt, ['logger', 'is_mel_spectrogram'], False):
                     if img.min() < -2:
                         img = normalize_mel(img)
@@ -4,6 +4,7 @@ import torch.nn
 from kornia.augmentation import RandomResizedCrop
 from torch.cuda.amp import autocast
 
+from data.images.byol_attachment import byol_augmentations, uint8_to_float
 from trainer.inject import Injector, create_injector
 from trainer.losses import extract_params_from_state
 from utils.util import opt_get
@@ -457,6 +458,40 @@ class RandomCropInjector(Injector):
         return {self.output: self.operator(state[self.input])}
 
 
+# Applies the BYOL augmentations to each of the images in [in], storing the results in the corresponding [out] keys.
+# Augmentations are done across the whole batch at once on whatever device the inputs live on; pairs with the
+# 'byol_dataset' dataset mode. uint8 inputs are converted to float here, so they can stay uint8 until they reach the GPU.
+class ByolAugmentInjector(Injector):
+    def __init__(self, opt, env):
+        super().__init__(opt, env)
+        self.aug = byol_augmentations(opt['crop_size'], opt_get(opt, ['for_sr'], False))
+        # The paper calls for normalization. Most datasets/models in this repo don't use this.
+        # Recommend setting true if you want to train exactly like the paper.
+        self.normalize = opt_get(opt, ['normalize'], False)
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+    def forward(self, state):
+        res = {}
+        with torch.no_grad():
+            for i, o in zip(self.input, self.output):
+                aug = self.aug(uint8_to_float(state[i]))
+                if self.normalize:
+                    mean, std = self.mean.to(aug), self.std.to(aug)
+                    aug = (aug - mean) / std
+                res[o] = aug
+        return res
+
+
+# Converts uint8 images produced by datasets with `uint8_transfer` set back into floats in [0,1].
+class Uint8ToFloatInjector(Injector):
+    def __init__(self, opt, env):
+        super().__init__(opt, env)
+
+    def forward(self, state):
+        return {self.output: uint8_to_float(state[self.input])}
+
+
 class Stylegan2NoiseInjector(Injector):
     def __init__(self, opt, env):
         super().__init__(opt, env)